@@ -1,119 +1,169 @@
-import base64
 import logging
 import os
+import selectors
+import threading
+import time
 from collections import deque
-from datetime import datetime, timezone
-from multiprocessing import Pipe, Process
-from typing import NoReturn, NamedTuple, Optional
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from functools import partial, lru_cache
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection
+from typing import NamedTuple, Optional, List, Tuple, Dict, Set, Any, Deque
 
-from backup_utils.backup_file import BackupFile
 from src.backup_scheduler.client_request_handler import ClientRequestHandler
-from src.backup_scheduler.node_handler_process import NodeHandlerProcess, CORRECT_FILE_FORMAT, WIP_FILE_FORMAT, \
-    SAME_FILE_FORMAT
+from src.backup_scheduler.node_handler_process import NodeHandlerProcess, BackupStatus
 from src.database.database import Database
 from src.database.entities.finished_task import FinishedTask
 
 SECONDS_TO_MINUTES = 60
-WRITE_FILE_PATH_TEMPLATE = '%s/backup_%d_%s_%s'
 SECONDS_TO_WAIT_CLIENT = 10
 MAX_FINISHED_TASKS_TO_STORE = 10
 
+NodeTaskKey = Tuple[str, str]
+QueueKey = Tuple[str, str, str]
+
 
 class ScheduledTask(NamedTuple):
     node_name: str
     node_address: str
     node_port: int
     node_path: str
-    frequency: int
+    frequency_s: float
     last_checksum: str
-    last_backup: Optional[datetime] = None
+    last_backup_ts: Optional[float] = None
+    retry_after_ts: Optional[float] = None
+
+    def seconds_to_run(self, now_ts: float) -> float:
+        """
+        Calculates the seconds left until it should run
 
-    def should_run(self) -> bool:
+        :param now_ts: the actual epoch timestamp
+        :return: the seconds left, zero or negative if it should run now
+        """
+        seconds_to_run = 0 if self.last_backup_ts is None else self.last_backup_ts + self.frequency_s - now_ts
+        if self.retry_after_ts is not None:
+            seconds_to_run = max(seconds_to_run, self.retry_after_ts - now_ts)
+        return seconds_to_run
+
+    def should_run(self, now_ts: float) -> bool:
         """
         Calculates whether it should run or not
 
+        :param now_ts: the actual epoch timestamp
         :return: a boolean
         """
-        return not self.last_backup or \
-               (datetime.now() - self.last_backup).seconds / SECONDS_TO_MINUTES > self.frequency
+        if self.retry_after_ts is not None and now_ts < self.retry_after_ts:
+            return False
+        return self.last_backup_ts is None or now_ts - self.last_backup_ts > self.frequency_s
 
 
 class RunningTask(NamedTuple):
     write_file_path: str
-    process: Process
 
-    def is_running(self):
-        return self.process.is_alive()
 
-    def backup_is_correct(self) -> bool:
+class CachedNodeData(NamedTuple):
+    version: int
+    node_address: str
+    node_port: int
+    tasks: List[Tuple[str, int]]
+    finished_tasks: Dict[str, List[FinishedTask]]
+
+
+class BackupScheduler:
+    """
+    Backup scheduler
+    """
+    logger = logging.getLogger(__module__)
+    schedule: List[ScheduledTask]
+    pool: Optional[ProcessPoolExecutor]
+    running_tasks: Dict[NodeTaskKey, RunningTask]
+    task_queue: Deque[QueueKey]
+    _queued_keys: Set[QueueKey]
+    _schedule_version: int
+    _node_names_cache: Tuple[int, Set[str]]
+    _node_cache: Dict[str, CachedNodeData]
+    _retry_after: Dict[NodeTaskKey, float]
+
+    def _invalidate_cache(self) -> None:
         """
-        Cleanup all backup unnecessary files, return True if backup is of, else False
+        Invalidates the cached database reads, must be called after every database mutation
+        """
+        self._schedule_version += 1
 
-        :return: a boolean
+    def _get_node_names(self) -> Set[str]:
         """
-        if os.path.isfile(CORRECT_FILE_FORMAT % self.write_file_path):
-            os.remove(CORRECT_FILE_FORMAT % self.write_file_path)
-            return True
-        else:
-            if os.path.isfile(self.write_file_path):
-                os.remove(self.write_file_path)
-            if os.path.isfile(WIP_FILE_FORMAT % self.write_file_path):
-                os.remove(WIP_FILE_FORMAT % self.write_file_path)
-            return False
+        Gets the node names from the cache, querying the database if the cache is outdated
 
-    def backup_is_same(self) -> bool:
+        :return: a set of node names
         """
-        Checks if the backup is the same as the previous one
+        version, node_names = self._node_names_cache
+        if version != self._schedule_version:
+            node_names = self.database.get_node_names()
+            self._node_names_cache = (self._schedule_version, node_names)
+            self._node_cache = {node_name: node_data for node_name, node_data in self._node_cache.items()
+                                if node_name in node_names}
+        return node_names
 
-        :return: a boolean
+    def _get_node_data(self, node_name: str) -> CachedNodeData:
         """
-        if os.path.isfile(SAME_FILE_FORMAT % self.write_file_path):
-            os.remove(SAME_FILE_FORMAT % self.write_file_path)
-            return True
-        else:
-            return False
+        Gets the address, tasks and last MAX_FINISHED_TASKS_TO_STORE finished tasks of a node from the cache,
+        querying the database if the cache is outdated
 
+        :raises:
+            UnexistentNodeError: if the node named 'node_name' is not registered
 
-class BackupScheduler:
-    """
-    Backup scheduler
-    """
-    logger = logging.getLogger(__module__)
+        :param node_name: the node name
+        :return: the cached node data
+        """
+        node_data = self._node_cache.get(node_name)
+        if node_data and node_data.version == self._schedule_version:
+            return node_data
+        node_address, node_port = self.database.get_node_address(node_name)
+        tasks = self.database.get_tasks_for_node(node_name)
+        finished_tasks = {path: self.database.get_node_finished_tasks(node_name, path,
+                                                                      limit=MAX_FINISHED_TASKS_TO_STORE)
+                          for path, _ in tasks}
+        node_data = CachedNodeData(version=self._schedule_version, node_address=node_address,
+                                   node_port=node_port, tasks=tasks, finished_tasks=finished_tasks)
+        self._node_cache[node_name] = node_data
+        return node_data
 
-    def _reload_schedule(self):
+    def _reload_schedule(self) -> None:
+        """
+        Reloads the schedule from the database
+        """
         BackupScheduler.logger.debug("Reloading schedule for backup")
         self.schedule = []
-        for node_name in self.database.get_node_names():
-            node_address, node_port = self.database.get_node_address(node_name)
-            for path, frequency in self.database.get_tasks_for_node(node_name):
-                finished_tasks = self.database.get_node_finished_tasks(node_name, path)
-                last_backup = (finished_tasks[0].timestamp if finished_tasks else None)
-                last_checksum = (finished_tasks[0].checksum if finished_tasks else "")
-                self.schedule.append(ScheduledTask(node_name=node_name, node_address=node_address,
-                                                   node_port=node_port, node_path=path,
-                                                   frequency=frequency,
-                                                   last_backup=last_backup,
-                                                   last_checksum=last_checksum))
-
-    def _clean_backup_path(self) -> NoReturn:
+        for node_name, node_address, node_port, path, frequency, last_backup, last_checksum \
+                in self.database.get_schedule_rows():
+            self.schedule.append(ScheduledTask(node_name=node_name, node_address=node_address,
+                                               node_port=node_port, node_path=path,
+                                               frequency_s=frequency * SECONDS_TO_MINUTES,
+                                               last_backup_ts=last_backup.timestamp() if last_backup else None,
+                                               last_checksum=last_checksum,
+                                               retry_after_ts=self._retry_after.get((node_name, path))))
+
+    def _clean_backup_path(self) -> None:
         """
         Cleans all files that are not part of registered backups
         """
-        valid_file_prefixes = set()
-        node_names = self.database.get_node_names()
-        for node_name in node_names:
-            for node_path, _ in self.database.get_tasks_for_node(node_name):
-                for ft in self.database.get_node_finished_tasks(node_name, node_path)[:MAX_FINISHED_TASKS_TO_STORE]:
+        valid_file_prefixes: Set[str] = set()
+        for node_name in self._get_node_names():
+            node_data = self._get_node_data(node_name)
+            for node_path, _ in node_data.tasks:
+                for ft in node_data.finished_tasks[node_path]:
                     valid_file_prefixes.update([ft.result_path])
         valid_file_prefixes.update([task.write_file_path for task in self.running_tasks.values()])
-        files_in_directory = os.listdir(self.backup_path)
-        files_to_delete = [f for f in files_in_directory if
-                           self.backup_path + "/" + f.split(".")[0] not in valid_file_prefixes]
-        for file_to_delete in files_to_delete:
-            os.remove(self.backup_path + "/" + file_to_delete)
+        valid_basenames = {os.path.basename(prefix) for prefix in valid_file_prefixes}
+        with os.scandir(self.backup_path) as entries:
+            for entry in entries:
+                if entry.name.partition(".")[0] not in valid_basenames:
+                    os.unlink(entry.path)
 
     def __init__(self, backup_path: str, database: Database,
-                 pipe_request_read: Pipe, pipe_request_answer: Pipe,
+                 pipe_request_read: Connection, pipe_request_answer: Connection,
                  max_processes_for_tasks: int):
         """
         Initializes the backup scheduler
@@ -130,21 +180,31 @@ class BackupScheduler:
         self.pipe_request_answer = pipe_request_answer
         self.schedule = []
         self.client_controller_process = None
+        self.pool = None
+        self.completion_read, self.completion_write = Pipe(False)
+        self._completion_lock = threading.Lock()
         self.running_tasks = {}
         self.command_parser = ClientRequestHandler(database)
         self.task_queue = deque()
+        self._queued_keys = set()
         self.max_processes = max_processes_for_tasks
+        self._schedule_version = 0
+        self._node_names_cache = (-1, set())
+        self._node_cache = {}
+        self._retry_after = {}
 
     @staticmethod
+    @lru_cache(maxsize=4096)
     def safe_base64(text: str) -> str:
         """
         Generates a safe base64 for filenames according rfc3548
         :param text: the text to encode
         :return: the safe text
         """
+        import base64
         return base64.b64encode(bytes(text, 'ascii'), b'-_').decode('ascii')
 
-    def _handle_client_request(self) -> NoReturn:
+    def _handle_client_request(self) -> None:
         """
         Handles a client request
         """
@@ -155,6 +215,7 @@ class BackupScheduler:
             command, args = request
             data, tasks_changed = self.command_parser.parse_command(command, args)
             if tasks_changed:
+                self._invalidate_cache()
                 self._reload_schedule()
                 self._clean_backup_path()
         except Exception as e:
@@ -162,95 +223,173 @@ class BackupScheduler:
             self.pipe_request_answer.send(("Error %s:" % str(e), data))
         self.pipe_request_answer.send(("OK", data))
 
-    def _dispatch_running_tasks(self):
-        """
-        Handles running tasks
-        """
-        now_running_tasks = {}
-        for node_data, task in self.running_tasks.items():
-            if not task.is_running():
-                if task.backup_is_correct():
-                    ft = FinishedTask(result_path=task.write_file_path,
-                                      kb_size=os.path.getsize(task.write_file_path) / 1024,
-                                      timestamp=datetime.now(),
-                                      checksum=BackupFile(task.write_file_path).get_hash())
-                    self.database.register_finished_task(node_data[0], node_data[1], ft)
-                    BackupScheduler.logger.info("Backup for node %s and path %s finished succesfully" % node_data)
-                    self._reload_schedule()
-                    self._clean_backup_path()
-                elif task.backup_is_same():
-                    ft = self.database.get_node_finished_tasks(node_data[0], node_data[1])[0]
-                    ft = FinishedTask(result_path=ft.result_path,
-                                      kb_size=ft.kb_size,
-                                      timestamp=datetime.now(),
-                                      checksum=ft.checksum)
-                    self.database.register_finished_task(node_data[0], node_data[1], ft)
-                    BackupScheduler.logger.info("Backup for node %s and path %s finished succesfully" % node_data)
-                    self._reload_schedule()
-                    self._clean_backup_path()
-                else:
-                    BackupScheduler.logger.error("Backup for node %s and path %s failed" % node_data)
+    def _notify_completion(self, node_data: NodeTaskKey, future: Future) -> None:
+        """
+        Sends a node handler result through the completion pipe, runs in the pool management thread
+
+        If the node handler raised an error or its worker died an empty result is sent
+
+        :param node_data: a tuple (node_name, node_path)
+        :param future: the finished future of the node handler
+        """
+        error = future.exception()
+        result: Optional[Dict[str, Any]] = None
+        if error is None:
+            result = future.result()
+        else:
+            BackupScheduler.logger.error("Node handler for node %s and path %s raised %s" %
+                                         (node_data[0], node_data[1], repr(error)))
+        with self._completion_lock:
+            self.completion_write.send((node_data, result))
+
+    def _submit(self, node_handler: NodeHandlerProcess) -> Future:
+        """
+        Submits a node handler to the pool, restarting the pool if a dead worker broke it
+
+        :param node_handler: the node handler to run
+        :return: the future of the node handler
+        """
+        assert self.pool
+        try:
+            return self.pool.submit(node_handler)
+        except BrokenProcessPool:
+            BackupScheduler.logger.error("A pool worker died, restarting the pool")
+            self.pool.shutdown(wait=False)
+            self.pool = ProcessPoolExecutor(self.max_processes)
+            return self.pool.submit(node_handler)
+
+    def _seconds_to_wait(self) -> float:
+        """
+        Calculates how long the main loop can wait for events before a scheduled task is due
+
+        Tasks already running or queued are skipped, their completion wakes up the loop
+
+        :return: the seconds to wait
+        """
+        now_ts = time.time()
+        seconds_to_wait: float = SECONDS_TO_WAIT_CLIENT
+        pending_keys = self.running_tasks.keys() | {(node_name, node_path)
+                                                    for node_name, node_path, _ in self._queued_keys}
+        for sched_task in self.schedule:
+            if (sched_task.node_name, sched_task.node_path) in pending_keys:
+                continue
+            seconds_to_wait = min(seconds_to_wait, sched_task.seconds_to_run(now_ts))
+        return max(seconds_to_wait, 0)
+
+    def _dispatch_running_tasks(self) -> None:
+        """
+        Handles the running tasks that sent their result through the completion pipe
+
+        A failed task is not retried until SECONDS_TO_WAIT_CLIENT have passed
+        """
+        completed: List[Tuple[NodeTaskKey, FinishedTask]] = []
+        failed = False
+        while self.completion_read.poll():
+            node_data, result = self.completion_read.recv()
+            task = self.running_tasks.pop(node_data)
+            status = result["status"] if result else BackupStatus.FAILED
+            if status == BackupStatus.FAILED:
+                self._retry_after[node_data] = time.time() + SECONDS_TO_WAIT_CLIENT
+                failed = True
+            else:
+                self._retry_after.pop(node_data, None)
+            if status == BackupStatus.SUCCESS:
+                ft = FinishedTask(result_path=task.write_file_path,
+                                  kb_size=result["kb_size"],
+                                  timestamp=datetime.now(),
+                                  checksum=result["checksum"])
+                completed.append((node_data, ft))
+            elif status == BackupStatus.SAME:
+                ft = self.database.get_node_finished_tasks(node_data[0], node_data[1], limit=1)[0]
+                ft = FinishedTask(result_path=ft.result_path,
+                                  kb_size=ft.kb_size,
+                                  timestamp=datetime.now(),
+                                  checksum=ft.checksum)
+                completed.append((node_data, ft))
             else:
-                now_running_tasks[node_data] = task
-        self.running_tasks = now_running_tasks
+                BackupScheduler.logger.error("Backup for node %s and path %s failed" % node_data)
+        if not completed:
+            if failed:
+                self.schedule = [sched_task._replace(retry_after_ts=self._retry_after.get((sched_task.node_name,
+                                                                                           sched_task.node_path)))
+                                 for sched_task in self.schedule]
+            return
+        with self.database.transaction():
+            for node_data, ft in completed:
+                self.database.register_finished_task(node_data[0], node_data[1], ft)
+                BackupScheduler.logger.info("Backup for node %s and path %s finished succesfully" % node_data)
+        self._invalidate_cache()
+        self._reload_schedule()
+        self._clean_backup_path()
 
-    def _run_new_tasks(self):
+    def _run_new_tasks(self) -> None:
         """
         Handles the schedule to run new tasks
         """
+        now_ts = time.time()
+        running_keys = self.running_tasks.keys()
+        task_queue = self.task_queue
+        queued_keys = self._queued_keys
         for sched_task in self.schedule:
-            if (sched_task.node_name, sched_task.node_path) in self.running_tasks:
+            if (sched_task.node_name, sched_task.node_path) in running_keys:
                 continue
-            if sched_task.should_run() and (
-                    sched_task.node_name, sched_task.node_path, sched_task.last_checksum) not in self.task_queue:
-                self.task_queue.appendleft((sched_task.node_name, sched_task.node_path, sched_task.last_checksum))
-            number_of_running_tasks = len(self.running_tasks)
-            for queued_task in range(min(self.max_processes - number_of_running_tasks, len(self.task_queue))):
-                node_name, node_path, last_checksum = self.task_queue.pop()
-                node_address, node_port = self.database.get_node_address(node_name)
-                write_file_path = WRITE_FILE_PATH_TEMPLATE % (self.backup_path,
-                                                              datetime.now().replace(tzinfo=timezone.utc).timestamp(),
-                                                              node_name,
-                                                              self.safe_base64(node_path))
-                node_handler = NodeHandlerProcess(node_address=node_address,
+            queue_key = (sched_task.node_name, sched_task.node_path, sched_task.last_checksum)
+            if sched_task.should_run(now_ts) and queue_key not in queued_keys:
+                task_queue.appendleft(queue_key)
+                queued_keys.add(queue_key)
+            for queued_task in range(min(self.max_processes - len(running_keys), len(task_queue))):
+                queue_key = task_queue.pop()
+                queued_keys.discard(queue_key)
+                node_name, node_path, last_checksum = queue_key
+                node_data = self._get_node_data(node_name)
+                write_file_path = f"{self.backup_path}/backup_{int(time.time())}_{node_name}_" \
+                                  f"{self.safe_base64(node_path)}"
+                node_handler = NodeHandlerProcess(node_address=node_data.node_address,
                                                   node_path=node_path,
-                                                  node_port=node_port,
+                                                  node_port=node_data.node_port,
                                                   write_file_path=write_file_path,
                                                   previous_checksum=last_checksum)
-                p = Process(target=node_handler)
-                p.start()
+                future = self._submit(node_handler)
+                future.add_done_callback(partial(self._notify_completion, (node_name, node_path)))
                 BackupScheduler.logger.debug("Backup order for node %s and path %s launched" %
                                              (node_name, node_path))
-                self.running_tasks[(node_name, node_path)] = RunningTask(write_file_path, p)
+                self.running_tasks[(node_name, node_path)] = RunningTask(write_file_path)
 
-    def __call__(self) -> NoReturn:
+    def __call__(self) -> None:
         """
         Code for running the main loop in the main process
 
         The process works this way, while true:
-            1. Checks for SECONDS_TO_WAIT_CLIENT the pipe from the client controller to see if theres an order to execute
+            1. Waits on the pipe from the client controller and the completion pipe until theres an event
+            or a scheduled task is due, never longer than SECONDS_TO_WAIT_CLIENT
                 1.1 If theres an order to execute it runs it
                 1.2 The answer to order is sent through self.pipe_request_answer
-            2. For each node handler process that ended:
-                If there is a .CORRECT it deletes it and registers the backup in the database
-                If there is no .CORRECT it deletes all files associated with that process backup
-            3. Launches new node handler processes for the backups that need to be done according last
+            2. For each node handler task result received through the completion pipe:
+                If its status is SUCCESS or SAME it registers the backup in the database
+                If its status is FAILED it logs the error, the node handler already discarded its file
+                A node handler that raised or whose worker died is handled as FAILED
+            3. Launches new node handler tasks in the pool for the backups that need to be done according last
             backup time, actual time and if there isnt a backup already running for that node and path
 
         If other error happens and the process must die:
-            * Kill all other processes then dies
+            * Shuts down the pool then dies
         """
         try:
+            self.pool = ProcessPoolExecutor(self.max_processes)
             self._reload_schedule()
             self._clean_backup_path()
+            selector = selectors.DefaultSelector()
+            selector.register(self.pipe_request_read, selectors.EVENT_READ)
+            selector.register(self.completion_read, selectors.EVENT_READ)
             while True:
-                if self.pipe_request_read.poll(SECONDS_TO_WAIT_CLIENT):
+                ready = {key.fileobj for key, _ in selector.select(self._seconds_to_wait())}
+                if self.pipe_request_read in ready:
                     self._handle_client_request()
-                self._dispatch_running_tasks()
+                if self.completion_read in ready:
+                    self._dispatch_running_tasks()
                 self._run_new_tasks()
-        except Exception as e:
+        except Exception:
             BackupScheduler.logger.exception("Aborting backup scheduler")
             self.pipe_request_answer.close()
-            for t in self.running_tasks.values():
-                if t.process.is_alive():
-                    t.process.termitate()
+            if self.pool:
+                self.pool.shutdown(wait=False)
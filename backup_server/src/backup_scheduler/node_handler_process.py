@@ -1,15 +1,26 @@
-import json
 import logging
 import os
 import socket
-from typing import NoReturn
+from enum import Enum
+from typing import Dict, Any, Tuple, BinaryIO
 
-from backup_utils.backup_file import BackupFile
-from backup_utils.blocking_socket_transferer import BlockingSocketTransferer
+from backup_utils.blocking_socket_transferer import BlockingSocketTransferer, BACKUP_SAME as SIDECAR_SAME, \
+    BACKUP_ABORT as SIDECAR_ABORT
 
-CORRECT_FILE_FORMAT = '%s.CORRECT'
-WIP_FILE_FORMAT = '%s.WIP'
-SAME_FILE_FORMAT = '%s.SAME'
+SOCKET_RECEIVE_BUFFER_SIZE = 4 << 20
+PROC_FD_PATH = '/proc/self/fd/%d'
+
+# Keep-alive connections to the sidecars opened by this pool worker, by (address, port)
+SIDECAR_CONNECTIONS: Dict[Tuple[str, int], socket.socket] = {}
+
+
+class BackupStatus(Enum):
+    """
+    Status of a finished backup sent to the scheduler
+    """
+    SUCCESS = 'SUCCESS'
+    SAME = 'SAME'
+    FAILED = 'FAILED'
 
 
 class NodeHandlerProcess:
@@ -36,65 +47,217 @@ class NodeHandlerProcess:
         self.write_file_path = write_file_path
         self.previous_checksum = previous_checksum
 
-    def __call__(self) -> NoReturn:
+    def _result(self, status: BackupStatus, checksum: str = "", kb_size: float = 0) -> Dict[str, Any]:
+        """
+        Builds the result of the backup returned to the scheduler
+
+        :param status: the backup status
+        :param checksum: the verified checksum of the backup if it is correct
+        :param kb_size: the size in kilobytes of the backup if it is correct
+        :return: a dict with the status, the write file path, the checksum and the size
+        """
+        return {"status": status, "write_file_path": self.write_file_path,
+                "checksum": checksum, "kb_size": kb_size}
+
+    def _open_connection(self) -> socket.socket:
+        """
+        Opens a new keep-alive connection to the node sidecar
+
+        :return: the connected socket
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RECEIVE_BUFFER_SIZE)
+        if hasattr(socket, 'TCP_QUICKACK'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        try:
+            sock.connect((self.node_address, self.node_port))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def _is_connection_alive(sock: socket.socket) -> bool:
+        """
+        Checks without blocking that an idle connection was not closed by the sidecar
+
+        :param sock: the idle socket
+        :return: True if the connection can be reused
+        """
+        try:
+            sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        # An idle connection has nothing to read, so this is either EOF or a protocol error
+        return False
+
+    def _get_connection(self) -> Tuple[socket.socket, bool]:
         """
-        Code for running the handler in a new process
+        Takes the idle connection to the node sidecar if there is a live one, otherwise opens a new one
+
+        :return: the socket and whether it is a reused connection
+        """
+        sock = SIDECAR_CONNECTIONS.pop((self.node_address, self.node_port), None)
+        if sock is not None:
+            if NodeHandlerProcess._is_connection_alive(sock):
+                return sock, True
+            sock.close()
+        return self._open_connection(), False
+
+    def _release_connection(self, sock: socket.socket):
+        """
+        Leaves the connection idle for the next backup of the node
+
+        :param sock: the socket after a completed request
+        """
+        previous = SIDECAR_CONNECTIONS.pop((self.node_address, self.node_port), None)
+        if previous is not None:
+            previous.close()
+        SIDECAR_CONNECTIONS[(self.node_address, self.node_port)] = sock
+
+    def _request_backup(self, sock: socket.socket) -> Tuple[int, int, str]:
+        """
+        Sends the backup request to the sidecar and reads its response
+
+        :param sock: the socket connected to the sidecar
+        :return: the sidecar status, the file size and the checksum
+        """
+        socket_transferer = BlockingSocketTransferer(sock)
+        socket_transferer.send_backup_request(self.previous_checksum, self.node_path)
+        return socket_transferer.receive_backup_response()
+
+    def _open_data_file(self) -> Tuple[BinaryIO, str]:
+        """
+        Opens the file where to receive the backup
+
+        Where supported the file is an anonymous O_TMPFILE in the backup directory so it never
+        shows up partially written, else it is a regular file in self.write_file_path
+
+        :return: a tuple (data_file, path) where path is the one to reach the file while open
+        """
+        if hasattr(os, 'O_TMPFILE'):
+            try:
+                fd = os.open(os.path.dirname(self.write_file_path), os.O_TMPFILE | os.O_WRONLY, 0o644)
+                return os.fdopen(fd, 'wb', buffering=0), PROC_FD_PATH % fd
+            except OSError:
+                NodeHandlerProcess.logger.debug("O_TMPFILE not supported, writing %s directly" %
+                                                self.write_file_path)
+        return open(self.write_file_path, 'wb', buffering=0), self.write_file_path
+
+    def _commit_data_file(self, data_file: BinaryIO, data_file_path: str):
+        """
+        Makes the verified backup visible in self.write_file_path and closes it, the file is
+        closed even if linking it fails
+
+        :raises:
+            OSError: if the backup could not be linked in self.write_file_path
+
+        :param data_file: the file opened by _open_data_file
+        :param data_file_path: the path returned by _open_data_file
+        """
+        try:
+            if data_file_path != self.write_file_path:
+                dir_fd = os.open(os.path.dirname(self.write_file_path), os.O_DIRECTORY)
+                try:
+                    os.link(data_file_path, os.path.basename(self.write_file_path), dst_dir_fd=dir_fd)
+                finally:
+                    os.close(dir_fd)
+        finally:
+            data_file.close()
+
+    def _discard_data_file(self, data_file: BinaryIO, data_file_path: str):
+        """
+        Closes the backup file and deletes it, anonymous files are reclaimed by the kernel on close
+
+        :param data_file: the file opened by _open_data_file
+        :param data_file_path: the path returned by _open_data_file
+        """
+        data_file.close()
+        if data_file_path == self.write_file_path and os.path.isfile(self.write_file_path):
+            os.remove(self.write_file_path)
+
+    def __call__(self) -> Dict[str, Any]:
+        """
+        Code for running the handler in a pool worker
 
         The process works this way:
             1. Connects to node sidecar asking for node_path compressed
-            2. If the backup is the same as previous checksum, writes a .SAME file
-            3. Downloads the file saving it in write file path
-                3.1. At start it writes an empty file named self.write_file_path but ending with .WIP
-                3.2. Starts saving the backup in a file located in self.write_file_path
-                3.3. When the backup is saved saves an empty file named self.write_file_path but ending with .CORRECT
-                3.4. Deletes the .WIP file
-            4. Ｓｅｐｐｕｋｕ
+            2. If the backup is the same as previous checksum, returns a BackupStatus.SAME result
+            3. Downloads the file saving it in write file path and verifies its checksum as it arrives
+            4. Returns a BackupStatus.SUCCESS result with the verified checksum and the size
+
+        The backup only appears in write file path once its checksum is verified, if anything
+        fails it returns a BackupStatus.FAILED result
+
+        :return: a dict with the status, the write file path, the checksum and the size
         """
         NodeHandlerProcess.logger.debug("Starting node handler for node %s:%d and path %s" %
                                         (self.node_address, self.node_port, self.node_path))
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = None
         try:
-            sock.connect((self.node_address, self.node_port))
-            socket_transferer = BlockingSocketTransferer(sock)
-            socket_transferer.send_plain_text(json.dumps({"checksum": self.previous_checksum,
-                                                          "path": self.node_path}))
+            sock, reused = self._get_connection()
+            try:
+                status, file_size, checksum = self._request_backup(sock)
+            except Exception as e:
+                if not reused:
+                    raise
+                # The sidecar may have dropped the idle connection after the liveness check
+                NodeHandlerProcess.logger.debug("Reused connection %s failed: %s, reconnecting" % (sock, e))
+                sock.close()
+                sock = self._open_connection()
+                status, file_size, checksum = self._request_backup(sock)
         except Exception as e:
-            NodeHandlerProcess.logger.exception("Error while writing socket %s: %s" % (sock, e))
+            NodeHandlerProcess.logger.exception("Error while requesting backup through socket %s: %s" % (sock, e))
             NodeHandlerProcess.logger.info("Terminating handler for node %s:%d and path %s" %
                                            (self.node_address, self.node_port, self.node_path))
-            return
-        msg = socket_transferer.receive_plain_text()
-        if msg == "SAME":
+            if sock is not None:
+                sock.close()
+            return self._result(BackupStatus.FAILED)
+        socket_transferer = BlockingSocketTransferer(sock)
+        if status == SIDECAR_SAME:
             NodeHandlerProcess.logger.debug("The backup was the same")
+            self._release_connection(sock)
             NodeHandlerProcess.logger.info("Terminating handler for node %s:%d and path %s" %
                                            (self.node_address, self.node_port, self.node_path))
-            open(SAME_FILE_FORMAT % self.write_file_path, 'w').close()
-            return
-        if msg == "ABORT":
+            return self._result(BackupStatus.SAME)
+        if status == SIDECAR_ABORT:
             NodeHandlerProcess.logger.error("Abort order sent from sidecar")
+            sock.close()
             NodeHandlerProcess.logger.info("Terminating handler for node %s:%d and path %s" %
                                            (self.node_address, self.node_port, self.node_path))
-            return
-        open(WIP_FILE_FORMAT % self.write_file_path, 'w').close()
-        data_file = open(self.write_file_path, 'ab')
+            return self._result(BackupStatus.FAILED)
+        # Only needed when the backup changed, so SAME-only workers never import it
+        from backup_utils.backup_file import BackupFileHasher
+        data_file, data_file_path = self._open_data_file()
+        hasher = BackupFileHasher()
         try:
-            socket_transferer.receive_file_data(data_file)
+            socket_transferer.receive_file_stream(data_file, file_size, hasher)
             NodeHandlerProcess.logger.debug("File data received")
-            checksum = socket_transferer.receive_plain_text()
         except Exception as e:
             NodeHandlerProcess.logger.exception("Error while reading socket %s: %s" % (sock, e))
             NodeHandlerProcess.logger.info("Terminating handler for node %s:%d and path %s" %
                                            (self.node_address, self.node_port, self.node_path))
-            return
-        data_file.close()
-        backup_file = BackupFile(self.write_file_path)
-        if backup_file.get_hash() == checksum:
+            self._discard_data_file(data_file, data_file_path)
+            sock.close()
+            return self._result(BackupStatus.FAILED)
+        self._release_connection(sock)
+        if hasher.hexdigest() == checksum:
             NodeHandlerProcess.logger.debug("Backup checksum: %s" % checksum)
         else:
             NodeHandlerProcess.logger.error("Error verifying checksum. Local: %s vs Server: %s" %
-                                            (backup_file.get_hash(), checksum))
-            return
-        open(CORRECT_FILE_FORMAT % self.write_file_path, 'w').close()
-        os.remove(WIP_FILE_FORMAT % self.write_file_path)
+                                            (hasher.hexdigest(), checksum))
+            self._discard_data_file(data_file, data_file_path)
+            return self._result(BackupStatus.FAILED)
+        try:
+            self._commit_data_file(data_file, data_file_path)
+        except OSError as e:
+            NodeHandlerProcess.logger.exception("Error while saving backup in %s: %s" % (self.write_file_path, e))
+            self._discard_data_file(data_file, data_file_path)
+            return self._result(BackupStatus.FAILED)
         NodeHandlerProcess.logger.info("Terminating handler for node %s:%d and path %s" %
                                        (self.node_address, self.node_port, self.node_path))
+        return self._result(BackupStatus.SUCCESS, checksum, file_size / 1024)
@@ -1,5 +1,6 @@
 from abc import abstractmethod
-from typing import NoReturn, List, Set, Tuple
+from datetime import datetime
+from typing import NoReturn, List, Set, Tuple, ContextManager, Optional
 
 from src.database.entities.finished_task import FinishedTask
 
@@ -75,15 +76,27 @@ class Database:
         """
 
     @abstractmethod
-    def get_node_finished_tasks(self, node_name: str, node_path: str) -> List[FinishedTask]:
+    def get_node_finished_tasks(self, node_name: str, node_path: str,
+                                limit: Optional[int] = None) -> List[FinishedTask]:
         """
         List all finished tasks for a node and path
 
         :param node_name: the node name
         :param node_path: the node path
+        :param limit: the maximum number of finished tasks to return, all of them if None
         :return: a list of finished tasks ordered from most recent to latest
         """
 
+    @abstractmethod
+    def get_schedule_rows(self) -> List[Tuple[str, str, int, str, int, Optional[datetime], str]]:
+        """
+        Lists every scheduled task joined with its node and its last finished task
+
+        :return: a list of tuples (node_name, node_address, node_port, node_path, frequency,
+                 last_backup_timestamp, last_backup_checksum), the last two being None and ""
+                 if the task has no finished tasks
+        """
+
     @abstractmethod
     def delete_scheduled_task(self, node_name: str, node_path: str) -> NoReturn:
         """
@@ -95,6 +108,13 @@ class Database:
         :param node_path: the node path of the task
         """
 
+    @abstractmethod
+    def transaction(self) -> ContextManager:
+        """
+        Groups the write operations made inside the returned context manager
+        so they are persisted together when it exits
+        """
+
     @abstractmethod
     def delete_node(self, node_name: str) -> NoReturn:
         """
@@ -1,7 +1,9 @@
 import json
 import os
 import pickle
-from typing import NoReturn, List, Dict, Tuple, Set
+from contextlib import contextmanager
+from datetime import datetime
+from typing import NoReturn, List, Dict, Tuple, Set, ContextManager, Optional
 
 from src.database.entities.finished_task import FinishedTask
 from .database import Database
@@ -82,6 +84,7 @@ class DiskDatabase(Database):
         self.database = {}
         self.logsize = 0
         self.writeahed_log = None
+        self.in_transaction = False
         self.load_database(database_path)
         self.uncommited_size = 0
 
@@ -99,7 +102,8 @@ class DiskDatabase(Database):
         if use_log:
             self.writeahed_log.write(json.dumps({'func': func,
                                                  'params': params}) + '\n')
-            self.writeahed_log.flush()
+            if not self.in_transaction:
+                self.writeahed_log.flush()
             self.logsize += 1
         getattr(self, func)(self.database, *params)
         if use_log:
@@ -107,6 +111,19 @@ class DiskDatabase(Database):
             if self.uncommited_size > MAX_UNCOMMITED:
                 self._commit()
 
+    @contextmanager
+    def transaction(self) -> ContextManager:
+        """
+        Groups the write operations made inside the returned context manager,
+        the writeahead log is flushed once when it exits instead of once per operation
+        """
+        self.in_transaction = True
+        try:
+            yield
+        finally:
+            self.in_transaction = False
+            self.writeahed_log.flush()
+
     @staticmethod
     def _register_node(database, node_name, node_addr, node_port):
         if node_name in database:
@@ -207,12 +224,14 @@ class DiskDatabase(Database):
         self._write_operation('_register_finished_task', [node_name, node_path, task.to_dict()],
                               use_log=True)
 
-    def get_node_finished_tasks(self, node_name: str, node_path: str) -> List[FinishedTask]:
+    def get_node_finished_tasks(self, node_name: str, node_path: str,
+                                limit: Optional[int] = None) -> List[FinishedTask]:
         """
         List all finished tasks for a node and path
 
         :param node_name: the node name
         :param node_path: the node path
+        :param limit: the maximum number of finished tasks to return, all of them if None
         :return: a list of finished tasks ordered from most recent to latest
         """
         if node_name not in self.database:
@@ -220,7 +239,28 @@ class DiskDatabase(Database):
         if node_path not in self.database[node_name]['finished_tasks']:
             return []
         return [FinishedTask.from_dict(ft)
-                for ft in self.database[node_name]['finished_tasks'][node_path]]
+                for ft in self.database[node_name]['finished_tasks'][node_path][:limit]]
+
+    def get_schedule_rows(self) -> List[Tuple[str, str, int, str, int, Optional[datetime], str]]:
+        """
+        Lists every scheduled task joined with its node and its last finished task
+
+        :return: a list of tuples (node_name, node_address, node_port, node_path, frequency,
+                 last_backup_timestamp, last_backup_checksum), the last two being None and ""
+                 if the task has no finished tasks
+        """
+        rows = []
+        for node_name, node in self.database.items():
+            for node_path, frequency in node['tasks']:
+                finished_tasks = node['finished_tasks'].get(node_path)
+                if finished_tasks:
+                    last_timestamp = datetime.fromisoformat(finished_tasks[0]['timestamp'])
+                    last_checksum = finished_tasks[0]['checksum']
+                else:
+                    last_timestamp, last_checksum = None, ""
+                rows.append((node_name, node['address'], node['port'], node_path, frequency,
+                             last_timestamp, last_checksum))
+        return rows
 
     @staticmethod
     def _delete_scheduled_task(database, node_name: str, node_path: str):
@@ -1,7 +1,12 @@
 import hashlib
 import tarfile
+import zlib
+from typing import Optional
 
 HASH_READ_BUF_SIZE = 1000000
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+PAX_HEADER_TYPES = (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.SOLARIS_XHDTYPE)
+GNU_NAME_TYPES = (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK)
 
 
 class BackupFile:
@@ -44,3 +49,112 @@ class BackupFile:
         archive.close()
         self.calculated_hash = sha256.hexdigest()
         return sha256.hexdigest()
+
+
+class BackupFileHasher:
+    """
+    Calculates the same hash as BackupFile.get_hash from the compressed backup data as it is
+    received, so the backup doesn't need to be read again from disk to be verified
+    """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.header = bytearray()
+        self.data_left = 0
+        self.padding_left = 0
+        self.hash_data = False
+        self.pax_data = None
+        self.pax_size = None
+        self.finished = False
+
+    def update(self, data: bytes):
+        """
+        Updates the hash with the next chunk of the compressed backup
+
+        :param data: the compressed data
+        """
+        if self.finished or self.decompressor.eof:
+            return
+        self._consume(memoryview(self.decompressor.decompress(data)))
+
+    def hexdigest(self) -> str:
+        """
+        Gets the hash of the data received until now
+
+        :return: a hash of the file
+        """
+        return self.sha256.hexdigest()
+
+    def _consume(self, data: memoryview):
+        """
+        Walks the decompressed tar data hashing the contents of the files
+
+        :param data: the decompressed data
+        """
+        while data and not self.finished:
+            if self.data_left:
+                chunk = data[:self.data_left]
+                if self.hash_data:
+                    self.sha256.update(chunk)
+                elif self.pax_data is not None:
+                    self.pax_data += chunk
+                self.data_left -= len(chunk)
+                data = data[len(chunk):]
+                if not self.data_left and self.pax_data is not None:
+                    self.pax_size = BackupFileHasher._pax_size(bytes(self.pax_data))
+                    self.pax_data = None
+            elif self.padding_left:
+                skipped = min(self.padding_left, len(data))
+                self.padding_left -= skipped
+                data = data[skipped:]
+            else:
+                missing = tarfile.BLOCKSIZE - len(self.header)
+                self.header += data[:missing]
+                data = data[missing:]
+                if len(self.header) == tarfile.BLOCKSIZE:
+                    self._start_member(bytes(self.header))
+                    self.header.clear()
+
+    def _start_member(self, header: bytes):
+        """
+        Reads a tar header and sets what to do with the data that follows it
+
+        :param header: the tar header block
+        """
+        try:
+            member = tarfile.TarInfo.frombuf(header, tarfile.ENCODING, "surrogateescape")
+        except tarfile.EOFHeaderError:
+            self.finished = True
+            return
+        size = member.size
+        if member.type not in PAX_HEADER_TYPES + GNU_NAME_TYPES:
+            if self.pax_size is not None:
+                size = self.pax_size
+                self.pax_size = None
+            # Like tarfile, only regular and unknown members are followed by their data
+            if not member.isfile() and member.type in tarfile.SUPPORTED_TYPES:
+                size = 0
+        self.hash_data = member.isfile()
+        self.pax_data = bytearray() if member.type == tarfile.XHDTYPE else None
+        self.data_left = size
+        self.padding_left = -size % tarfile.BLOCKSIZE
+
+    @staticmethod
+    def _pax_size(pax_data: bytes) -> Optional[int]:
+        """
+        Gets the size override from a pax extended header
+
+        :param pax_data: the pax extended header data
+        :return: the size of the next member if the header has one
+        """
+        size = None
+        pos = 0
+        while pos < len(pax_data):
+            length = int(pax_data[pos:pax_data.index(b' ', pos)])
+            record = pax_data[pax_data.index(b' ', pos) + 1:pos + length - 1]
+            keyword, _, value = record.partition(b'=')
+            if keyword == b'size':
+                size = int(value)
+            pos += length
+        return size
@@ -1,10 +1,20 @@
 import os
 import socket
+import struct
+from typing import Tuple
 
-DEFAULT_SOCKET_BUFFER_SIZE = 4096
+DEFAULT_SOCKET_BUFFER_SIZE = 65536
 OK_MESSAGE = "OK"
 OK_MESSAGE_LEN = len(OK_MESSAGE.encode('utf-8'))
 SIZE_NUMBER_SIZE = 20
+RECV_WAITALL_FLAGS = getattr(socket, 'MSG_WAITALL', 0)
+TEXT_SIZE_HEADER = struct.Struct('!I')
+CHECKSUM_SIZE = 32
+BACKUP_REQUEST_HEADER = struct.Struct('!%dsH' % CHECKSUM_SIZE)
+BACKUP_RESPONSE_HEADER = struct.Struct('!BQ%ds' % CHECKSUM_SIZE)
+BACKUP_DIFF = 0
+BACKUP_SAME = 1
+BACKUP_ABORT = 2
 
 
 class SocketClosed(Exception):
@@ -21,6 +31,33 @@ class BlockingSocketTransferer:
             raise SocketClosed
         return data
 
+    def controlled_recv_into(self, buffer: memoryview, flags: int = 0) -> int:
+        received = self.socket.recv_into(buffer, 0, flags)
+        if received == 0:
+            raise SocketClosed
+        return received
+
+    def receive_exact_into(self, buffer: memoryview):
+        received = 0
+        while received < len(buffer):
+            received += self.controlled_recv_into(buffer[received:], RECV_WAITALL_FLAGS)
+
+    @staticmethod
+    def checksum_to_bytes(checksum: str) -> bytes:
+        """
+        Packs an hexadecimal checksum in its raw digest bytes
+
+        :param checksum: the hexadecimal checksum
+        :return: the digest bytes, all zeros if the checksum is not a valid one
+        """
+        try:
+            digest = bytes.fromhex(checksum)
+        except ValueError:
+            digest = b''
+        if len(digest) != CHECKSUM_SIZE:
+            return bytes(CHECKSUM_SIZE)
+        return digest
+
     @staticmethod
     def size_to_bytes_number(size: int) -> bytes:
         text = str(size)
@@ -42,40 +79,92 @@ class BlockingSocketTransferer:
         text = self.receive_plain_text()
         assert text == OK_MESSAGE
 
-    def receive_file_data(self, file):
+    def receive_file_stream(self, file, file_size: int, hasher=None):
+        buffer = memoryview(bytearray(DEFAULT_SOCKET_BUFFER_SIZE))
+        left_to_receive = file_size
+        while left_to_receive > 0:
+            received = self.controlled_recv_into(buffer[:min(left_to_receive, DEFAULT_SOCKET_BUFFER_SIZE)],
+                                                 RECV_WAITALL_FLAGS)
+            written = 0
+            while written < received:
+                written += file.write(buffer[written:received])
+            if hasher is not None:
+                hasher.update(buffer[:received])
+            left_to_receive -= received
+
+    def receive_file_data(self, file) -> int:
         file_size = int(self.receive_fixed_size(SIZE_NUMBER_SIZE))
         self.send_ok()
-        while file_size > 0:
-            buffer = self.controlled_recv(DEFAULT_SOCKET_BUFFER_SIZE)
-            file.write(buffer)
-            file_size -= len(buffer)
+        self.receive_file_stream(file, file_size)
         self.send_ok()
+        return file_size
+
+    def send_file_stream(self, filename, file_size: int):
+        with open(filename, "rb") as file:
+            self.socket.sendfile(file, count=file_size)
 
     def send_file(self, filename):
         file_size = os.stat(filename).st_size
         self.socket.sendall(self.size_to_bytes_number(file_size))
         self.receive_ok()
-        with open(filename, "rb") as file:
-            while file_size > 0:
-                buffer = file.read(DEFAULT_SOCKET_BUFFER_SIZE)
-                self.socket.sendall(buffer)
-                file_size -= DEFAULT_SOCKET_BUFFER_SIZE
+        self.send_file_stream(filename, file_size)
         self.receive_ok()
 
+    def send_backup_request(self, previous_checksum: str, path: str):
+        """
+        Sends a backup request in a single write
+
+        :param previous_checksum: the hexadecimal checksum of the previous backup
+        :param path: the path to backup
+        """
+        encoded_path = path.encode('utf-8')
+        self.socket.sendall(BACKUP_REQUEST_HEADER.pack(self.checksum_to_bytes(previous_checksum),
+                                                       len(encoded_path)) + encoded_path)
+
+    def receive_backup_request(self) -> Tuple[str, str]:
+        """
+        Receives a backup request
+
+        :return: a tuple (previous_checksum, path)
+        """
+        header = bytearray(BACKUP_REQUEST_HEADER.size)
+        self.receive_exact_into(memoryview(header))
+        previous_checksum, path_size = BACKUP_REQUEST_HEADER.unpack(header)
+        encoded_path = bytearray(path_size)
+        self.receive_exact_into(memoryview(encoded_path))
+        return previous_checksum.hex(), encoded_path.decode('utf-8')
+
+    def send_backup_response(self, status: int, file_size: int = 0, checksum: str = ""):
+        """
+        Sends the header of a backup response, for BACKUP_DIFF the file data must follow
+
+        :param status: one of BACKUP_DIFF, BACKUP_SAME or BACKUP_ABORT
+        :param file_size: the size of the backup file that follows
+        :param checksum: the hexadecimal checksum of the backup file
+        """
+        self.socket.sendall(BACKUP_RESPONSE_HEADER.pack(status, file_size, self.checksum_to_bytes(checksum)))
+
+    def receive_backup_response(self) -> Tuple[int, int, str]:
+        """
+        Receives the header of a backup response
+
+        :return: a tuple (status, file_size, checksum)
+        """
+        header = bytearray(BACKUP_RESPONSE_HEADER.size)
+        self.receive_exact_into(memoryview(header))
+        status, file_size, checksum = BACKUP_RESPONSE_HEADER.unpack(header)
+        return status, file_size, checksum.hex()
+
     def send_plain_text(self, text):
         encoded_text = text.encode('utf-8')
-        self.socket.sendall(self.size_to_bytes_number(len(encoded_text)))
-        self.socket.sendall(encoded_text)
+        self.socket.sendall(TEXT_SIZE_HEADER.pack(len(encoded_text)) + encoded_text)
 
     def receive_plain_text(self) -> str:
-        size_to_recv = int(self.receive_fixed_size(SIZE_NUMBER_SIZE))
-        result = ""
-        recv_size = 0
-        while recv_size < size_to_recv:
-            new_data = self.controlled_recv(size_to_recv - recv_size)
-            result += new_data.decode('utf-8')
-            recv_size += len(new_data)
-        return result
+        header = bytearray(TEXT_SIZE_HEADER.size)
+        self.receive_exact_into(memoryview(header))
+        encoded_text = bytearray(TEXT_SIZE_HEADER.unpack(header)[0])
+        self.receive_exact_into(memoryview(encoded_text))
+        return encoded_text.decode('utf-8')
 
     def abort(self):
         self.send_plain_text("ABORT")
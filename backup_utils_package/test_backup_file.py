@@ -2,7 +2,7 @@ import os
 import shutil
 import unittest
 
-from backup_utils.backup_file import BackupFile
+from backup_utils.backup_file import BackupFile, BackupFileHasher
 
 
 class TestBackupFile(unittest.TestCase):
@@ -11,6 +11,9 @@ class TestBackupFile(unittest.TestCase):
         os.mkdir('/tmp/test_path')
         with open('/tmp/test_path/test_file', "w") as test_file:
             test_file.write("dummy text")
+        os.mkdir('/tmp/test_path/' + 'long_directory_name' * 10)
+        with open('/tmp/test_path/' + 'long_directory_name' * 10 + '/big_file', "wb") as test_file:
+            test_file.write(os.urandom(3000000))
 
     def tearDown(self) -> None:
         shutil.rmtree('/tmp/test_path', ignore_errors=True)
@@ -20,6 +23,17 @@ class TestBackupFile(unittest.TestCase):
         backup_file2 = BackupFile('/tmp/file.tgz')
         self.assertEqual(backup_file2.get_hash(), backup_file.get_hash())
 
+    def test_streaming_hash_equals_file_hash(self):
+        backup_file = BackupFile.create_from_path('/tmp/test_path', '/tmp/file.tgz')
+        hasher = BackupFileHasher()
+        with open('/tmp/file.tgz', 'rb') as file:
+            while True:
+                data = file.read(1000)
+                if not data:
+                    break
+                hasher.update(data)
+        self.assertEqual(backup_file.get_hash(), hasher.hexdigest())
+
     def test_generate_different_same_hash(self):
         backup_file = BackupFile.create_from_path('/tmp/test_path', '/tmp/file.tgz')
         backup_file2 = BackupFile.create_from_path('/tmp/test_path', '/tmp/file2.tgz')
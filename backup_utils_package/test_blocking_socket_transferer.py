@@ -1,10 +1,11 @@
 import hashlib
+import io
 import os
 import socket
 import unittest
 from multiprocessing import Barrier, Process
 
-from backup_utils.blocking_socket_transferer import BlockingSocketTransferer
+from backup_utils.blocking_socket_transferer import BlockingSocketTransferer, BACKUP_DIFF
 
 
 def message_sender(barrier, port):
@@ -29,6 +30,23 @@ def file_sender(barrier, port, input_file):
     transferer.close()
 
 
+def backup_responder(barrier, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('', port))
+    sock.listen(1)
+    barrier.wait()
+    c, addr = sock.accept()
+    transferer = BlockingSocketTransferer(c)
+    previous_checksum, path = transferer.receive_backup_request()
+    transferer.send_backup_response(BACKUP_DIFF, len(path), previous_checksum)
+    c.close()
+
+
+class ShortWriter(io.BytesIO):
+    def write(self, data) -> int:
+        return super().write(data[:100])
+
+
 class TestBlockingSocketTransferer(unittest.TestCase):
     TEST_PORT = 8000
 
@@ -43,7 +61,8 @@ class TestBlockingSocketTransferer(unittest.TestCase):
         self.p = None
 
     def tearDown(self) -> None:
-        self.p.join()
+        if self.p:
+            self.p.join()
         TestBlockingSocketTransferer.TEST_PORT += 1
 
     def test_send_text(self):
@@ -89,3 +108,26 @@ class TestBlockingSocketTransferer(unittest.TestCase):
         os.remove('/tmp/big_dummy_file_test')
         os.remove('/tmp/big_dummy_file_test_out')
         socket_transferer.close()
+
+    def test_receive_file_stream_with_short_writes(self):
+        data = os.urandom(5000)
+        sender, receiver = socket.socketpair()
+        sender.sendall(data)
+        write_file = ShortWriter()
+        BlockingSocketTransferer(receiver).receive_file_stream(write_file, len(data))
+        self.assertEqual(write_file.getvalue(), data)
+        sender.close()
+        receiver.close()
+
+    def test_send_backup_request_and_response(self):
+        self.p = Process(target=backup_responder, args=(self.barrier, TestBlockingSocketTransferer.TEST_PORT))
+        self.p.start()
+        self.barrier.wait()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('localhost', TestBlockingSocketTransferer.TEST_PORT))
+        socket_transferer = BlockingSocketTransferer(sock)
+        checksum = hashlib.sha256(b"dummy").hexdigest()
+        socket_transferer.send_backup_request(checksum, "/tmp/ñandú")
+        self.assertEqual(socket_transferer.receive_backup_response(),
+                         (BACKUP_DIFF, len("/tmp/ñandú"), checksum))
+        socket_transferer.close()
@@ -1,10 +1,11 @@
-import json
 import logging
+import os
 import socket
 from multiprocessing import Process
 
 from backup_utils.backup_file import BackupFile
-from backup_utils.blocking_socket_transferer import BlockingSocketTransferer
+from backup_utils.blocking_socket_transferer import BlockingSocketTransferer, SocketClosed, BACKUP_DIFF, \
+    BACKUP_SAME, BACKUP_ABORT
 
 TMP_BACKUP_PATH = "/tmp/%d"
 DEFAULT_SOCKET_BUFFER_SIZE = 4096
@@ -29,52 +30,76 @@ class SidecarProcess:
             p.start()
             client_sock.close()
             self.backup_no += 1
-            self.backup_no = self.backup_no % self.listen_backlog
             self.process_list = [p for p in self.process_list if p.is_alive()] + [p]
 
+    @staticmethod
+    def __abort(socket_transferer: BlockingSocketTransferer):
+        """
+        Sends an abort response and closes the socket
+
+        :param socket_transferer: the socket transferer of the connection
+        """
+        socket_transferer.send_backup_response(BACKUP_ABORT)
+        socket_transferer.close()
+
     @staticmethod
     def __handle_client_connection(client_sock, backup_no: int):
         """
-        Read message from a specific client socket and closes the socket
+        Serves backup requests from a specific client socket until the client closes it
 
-        If a problem arises in the communication with the client, the
-        client socket will also be closed
+        The connection is kept alive between requests so the scheduler can reuse it for
+        the following backups of the node. If a problem arises in the communication with
+        the client, the client socket will be closed
         """
         socket_transferer = BlockingSocketTransferer(client_sock)
         try:
-            msg = socket_transferer.receive_plain_text()
-            msg = json.loads(msg)
-            path, previous_checksum = msg['path'], msg['checksum']
+            while SidecarProcess.__handle_backup_request(socket_transferer, TMP_BACKUP_PATH % backup_no):
+                pass
+        finally:
+            if os.path.isfile(TMP_BACKUP_PATH % backup_no):
+                os.remove(TMP_BACKUP_PATH % backup_no)
+
+    @staticmethod
+    def __handle_backup_request(socket_transferer: BlockingSocketTransferer, tmp_backup_path: str) -> bool:
+        """
+        Reads a backup request from the connection and answers it
+
+        :param socket_transferer: the socket transferer of the connection
+        :param tmp_backup_path: the path where to make the backup file
+        :return: True if the connection can be reused for another request, False if it was closed
+        """
+        try:
+            previous_checksum, path = socket_transferer.receive_backup_request()
             SidecarProcess.logger.debug("Previous checksum for path %s is '%s'" % (path, previous_checksum))
+        except SocketClosed:
+            SidecarProcess.logger.debug("Connection closed by the client")
+            socket_transferer.close()
+            return False
         except (OSError, TimeoutError) as e:
-            SidecarProcess.logger.exception("Error while reading socket %s: %s" % (client_sock, e))
-            socket_transferer.abort()
-            return
+            SidecarProcess.logger.exception("Error while reading socket %s: %s" % (socket_transferer.socket, e))
+            SidecarProcess.__abort(socket_transferer)
+            return False
         try:
-            backup_file = BackupFile.create_from_path(path, TMP_BACKUP_PATH % backup_no)
+            backup_file = BackupFile.create_from_path(path, tmp_backup_path)
         except Exception:
             SidecarProcess.logger.exception("Error while making backup file")
-            socket_transferer.abort()
-            return
+            SidecarProcess.__abort(socket_transferer)
+            return False
         file_checksum = backup_file.get_hash()
         if file_checksum == previous_checksum:
             SidecarProcess.logger.info("Previous checksum equals to actual data, skipping backup")
-            socket_transferer.send_plain_text("SAME")
-            socket_transferer.abort()
-            return
-        else:
-            socket_transferer.send_plain_text("DIFF")
+            socket_transferer.send_backup_response(BACKUP_SAME)
+            return True
         try:
-            socket_transferer.send_file(TMP_BACKUP_PATH % backup_no)
+            file_size = os.stat(tmp_backup_path).st_size
+            socket_transferer.send_backup_response(BACKUP_DIFF, file_size, file_checksum)
+            socket_transferer.send_file_stream(tmp_backup_path, file_size)
             SidecarProcess.logger.debug("Backup file sent")
-            socket_transferer.send_plain_text(file_checksum)
         except Exception as e:
-            SidecarProcess.logger.exception("Error while writing socket %s: %s" % (client_sock, e))
-            socket_transferer.abort()
-            return
-        finally:
+            SidecarProcess.logger.exception("Error while writing socket %s: %s" % (socket_transferer.socket, e))
             socket_transferer.close()
-        return
+            return False
+        return True
 
     def __accept_new_connection(self):
         """
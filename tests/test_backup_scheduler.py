@@ -1,5 +1,7 @@
 import os
 import shutil
+import signal
+import time
 import unittest
 from multiprocessing import Process, Pipe, Barrier
 from threading import BrokenBarrierError
@@ -12,6 +14,7 @@ from src.database.disk_database import DiskDatabase
 class MockNodeHandler:
     BARRIER = None
     PATH_TO_BACKUP = '/tmp/data_for_backup'
+    KILL_FLAG_PATH = '/tmp/kill_node_handler'
 
     def __init__(self, node_address: str, node_port: int,
                  node_path: str, write_file_path: str, previous_checksum: str):
@@ -22,13 +25,19 @@ class MockNodeHandler:
         self.previous_checksum = previous_checksum
 
     def __call__(self, *args, **kwargs):
+        if os.path.exists(MockNodeHandler.KILL_FLAG_PATH):
+            os.remove(MockNodeHandler.KILL_FLAG_PATH)
+            os.kill(os.getpid(), signal.SIGKILL)
         MockNodeHandler.BARRIER.wait()
         bf = BackupFile.create_from_path(MockNodeHandler.PATH_TO_BACKUP,
                                          self.write_file_path)
         if bf.get_hash() == self.previous_checksum:
-            open(self.write_file_path + ".SAME", "w").close()
+            return {"status": node_handler_process.BackupStatus.SAME,
+                    "write_file_path": self.write_file_path, "checksum": "", "kb_size": 0}
         else:
-            open(self.write_file_path + ".CORRECT", "w").close()
+            return {"status": node_handler_process.BackupStatus.SUCCESS,
+                    "write_file_path": self.write_file_path, "checksum": bf.get_hash(),
+                    "kb_size": os.path.getsize(self.write_file_path) / 1024}
 
 
 class TestBackupScheduler(unittest.TestCase):
@@ -70,6 +79,8 @@ class TestBackupScheduler(unittest.TestCase):
         shutil.rmtree('/tmp/data_for_backup', ignore_errors=True)
         node_handler_process.NodeHandlerProcess = self.node_handler
         self.client_listener_send.close()
+        if os.path.exists(MockNodeHandler.KILL_FLAG_PATH):
+            os.remove(MockNodeHandler.KILL_FLAG_PATH)
 
     def test_cleanup_at_start(self):
         self.client_listener_send.send(('query_backups', {'name': 'prueba',
@@ -90,6 +101,28 @@ class TestBackupScheduler(unittest.TestCase):
         self.assertEqual(database.get_node_address('prueba'),
                          ('127.0.0.1', 8080))
 
+    def test_task_retried_after_worker_killed(self):
+        open(MockNodeHandler.KILL_FLAG_PATH, 'w').close()
+        self.client_listener_send.send(('add_node', {'name': 'prueba',
+                                                     'address': '127.0.0.1',
+                                                     'port': 8080}))
+        message, data = self.client_listener_recv.recv()
+        self.assertEqual(message, "OK")
+        self.client_listener_send.send(('add_task', {'name': 'prueba',
+                                                     'path': '/path',
+                                                     'frequency': 1}))
+        message, data = self.client_listener_recv.recv()
+        self.assertEqual(message, "OK")
+        self.barrier.wait(timeout=60)
+        self.assertFalse(os.path.exists(MockNodeHandler.KILL_FLAG_PATH))
+        data = []
+        while not data:
+            self.client_listener_send.send(('query_backups', {'name': 'prueba',
+                                                              'path': '/path'}))
+            message, data = self.client_listener_recv.recv()
+            self.assertEqual(message, "OK")
+        self.assertEqual(len(data), 1)
+
     def test_simple_add_task_and_check_done_same_data(self):
         self.client_listener_send.send(('add_node', {'name': 'prueba',
                                                      'address': '127.0.0.1',
@@ -235,3 +268,55 @@ class TestBackupScheduler(unittest.TestCase):
         message, data = self.client_listener_recv.recv()
         self.assertEqual(message, "OK")
         self.assertEqual(len(data), 0)
+
+
+
+class TestBackupSchedulerWait(unittest.TestCase):
+    def setUp(self):
+        from src.backup_scheduler import backup_scheduler
+        self.module = backup_scheduler
+        shutil.rmtree('/tmp/disk_db_wait', ignore_errors=True)
+        os.mkdir('/tmp/disk_db_wait')
+        shutil.rmtree('/tmp/backup_scheduler_wait_path', ignore_errors=True)
+        os.mkdir('/tmp/backup_scheduler_wait_path')
+        scheduler_recv, self.client_send = Pipe(False)
+        self.client_recv, scheduler_send = Pipe(False)
+        self.scheduler = backup_scheduler.BackupScheduler('/tmp/backup_scheduler_wait_path',
+                                                          DiskDatabase('/tmp/disk_db_wait'),
+                                                          scheduler_recv, scheduler_send, 10)
+        self.task = backup_scheduler.ScheduledTask(node_name='prueba', node_address='127.0.0.1',
+                                                   node_port=8080, node_path='/path',
+                                                   frequency_s=60, last_checksum='')
+
+    def tearDown(self) -> None:
+        shutil.rmtree('/tmp/disk_db_wait', ignore_errors=True)
+        shutil.rmtree('/tmp/backup_scheduler_wait_path', ignore_errors=True)
+
+    def test_wait_without_tasks(self):
+        self.assertEqual(self.scheduler._seconds_to_wait(), self.module.SECONDS_TO_WAIT_CLIENT)
+
+    def test_wait_until_next_task(self):
+        self.scheduler.schedule = [self.task._replace(last_backup_ts=time.time() - 55)]
+        self.assertTrue(0 < self.scheduler._seconds_to_wait() <= 5)
+        self.scheduler.schedule.append(self.task._replace(node_path='/other'))
+        self.assertEqual(self.scheduler._seconds_to_wait(), 0)
+
+    def test_wait_while_due_task_is_running(self):
+        self.scheduler.schedule = [self.task]
+        self.scheduler.running_tasks[('prueba', '/path')] = self.module.RunningTask('/tmp/backup')
+        self.assertTrue(self.scheduler._seconds_to_wait() > 0)
+
+    def test_wait_while_due_task_is_queued(self):
+        self.scheduler.schedule = [self.task]
+        self.scheduler._queued_keys.add(('prueba', '/path', ''))
+        self.assertTrue(self.scheduler._seconds_to_wait() > 0)
+
+    def test_failed_backup_is_retried_after_wait(self):
+        self.scheduler.schedule = [self.task]
+        self.scheduler.running_tasks[('prueba', '/path')] = self.module.RunningTask('/tmp/backup')
+        self.scheduler.completion_write.send((('prueba', '/path'), None))
+        self.scheduler._dispatch_running_tasks()
+        now_ts = time.time()
+        self.assertFalse(self.scheduler.schedule[0].should_run(now_ts))
+        self.assertTrue(self.scheduler._seconds_to_wait() > 0)
+        self.assertTrue(self.scheduler.schedule[0].should_run(now_ts + self.module.SECONDS_TO_WAIT_CLIENT + 1))
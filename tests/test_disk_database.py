@@ -138,6 +138,18 @@ class TestDiskDatabase(unittest.TestCase):
             self.database = DiskDatabase('/tmp/disk_db_concus')
         self.assertEqual(self.database.get_node_finished_tasks('node', '/home'), tasks)
 
+    def test_get_finished_tasks_with_limit(self):
+        self.database.register_node('node', 'address', 1111)
+        self.database.add_scheduled_task('node', '/home', 4)
+        tasks = []
+        for i in range(25):
+            ft = FinishedTask('/tmp/backup%d' % i, 223.43, datetime.now(), checksum="")
+            tasks.insert(0, ft)
+            self.database.register_finished_task('node', '/home', ft)
+        self.assertEqual(self.database.get_node_finished_tasks('node', '/home', limit=10), tasks[:10])
+        self.assertEqual(self.database.get_node_finished_tasks('node', '/home', limit=1), tasks[:1])
+        self.assertEqual(self.database.get_node_finished_tasks('node', '/home'), tasks)
+
     def test_recover_2n_steps_add_finished_tasks(self):
         self.database.register_node('node', 'address', 1111)
         self.database.add_scheduled_task('node', '/home', 4)
@@ -168,6 +180,36 @@ class TestDiskDatabase(unittest.TestCase):
         self.database = DiskDatabase('/tmp/disk_db_concus')
         self.assertEqual(self.database.get_node_finished_tasks('node', '/home'), [])
 
+    def test_finished_tasks_in_transaction_and_load(self):
+        self.database.register_node('node', 'address', 1111)
+        self.database.add_scheduled_task('node', '/home', 4)
+        self.database.add_scheduled_task('node', '/etc', 4)
+        ft1 = FinishedTask('/tmp/backup1', 223.43, datetime.now(), checksum="")
+        ft2 = FinishedTask('/tmp/backup2', 22.43, datetime.now(), checksum="")
+        with self.database.transaction():
+            self.database.register_finished_task('node', '/home', ft1)
+            self.database.register_finished_task('node', '/etc', ft2)
+            self.assertEqual(self.database.get_node_finished_tasks('node', '/home'), [ft1])
+        self.database = DiskDatabase('/tmp/disk_db_concus')
+        self.assertEqual(self.database.get_node_finished_tasks('node', '/home'), [ft1])
+        self.assertEqual(self.database.get_node_finished_tasks('node', '/etc'), [ft2])
+
+    def test_get_schedule_rows(self):
+        self.database.register_node('node', 'address', 1111)
+        self.database.register_node('node2', 'address2', 2222)
+        self.database.add_scheduled_task('node', '/home', 4)
+        self.database.add_scheduled_task('node', '/etc', 5)
+        self.database.add_scheduled_task('node2', '/home', 6)
+        ft1 = FinishedTask('/tmp/backup1', 223.43, datetime.now(), checksum="checksum1")
+        ft2 = FinishedTask('/tmp/backup2', 22.43, datetime.now(), checksum="checksum2")
+        self.database.register_finished_task('node', '/home', ft1)
+        self.database.register_finished_task('node', '/home', ft2)
+        self.database = DiskDatabase('/tmp/disk_db_concus')
+        self.assertEqual(sorted(self.database.get_schedule_rows()),
+                         [('node', 'address', 1111, '/etc', 5, None, ""),
+                          ('node', 'address', 1111, '/home', 4, ft2.timestamp, "checksum2"),
+                          ('node2', 'address2', 2222, '/home', 6, None, "")])
+
     def test_delete_unexistent_stuff(self):
         for i in range(324):
             self.database.register_node('node%d' % i, 'address', 1111)
@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 import random
@@ -8,7 +7,8 @@ import unittest
 from multiprocessing import Process
 from time import sleep
 
-from backup_server.src.backup_scheduler.node_handler_process import NodeHandlerProcess
+from backup_server.src.backup_scheduler.node_handler_process import NodeHandlerProcess, BackupStatus, \
+    SIDECAR_CONNECTIONS
 from backup_utils.backup_file import BackupFile
 from backup_utils.blocking_socket_transferer import BlockingSocketTransferer
 from sidecar.src.sidecar_process import SidecarProcess
@@ -37,6 +37,9 @@ class TestSidecar(unittest.TestCase):
     def tearDown(self) -> None:
         if self.p.is_alive():
             self.p.terminate()
+        for sock in SIDECAR_CONNECTIONS.values():
+            sock.close()
+        SIDECAR_CONNECTIONS.clear()
         shutil.rmtree('/tmp/backup_output', ignore_errors=True)
         os.remove('/tmp/example')
         TestSidecar.PORT += 1
@@ -47,7 +50,8 @@ class TestSidecar(unittest.TestCase):
                                                   '/tmp/backup_output/out',
                                                   'dummy_checksum')
         sleep(5)
-        node_handler_process()
+        result = node_handler_process()
+        self.assertEqual(result["status"], BackupStatus.SUCCESS)
         expected_file = BackupFile.create_from_path('/tmp/example', "/tmp/backup_output/out2")
         backup_file = BackupFile("/tmp/backup_output/out")
         self.assertEqual(expected_file.get_hash(), backup_file.get_hash())
@@ -60,8 +64,39 @@ class TestSidecar(unittest.TestCase):
                                                   '/tmp/backup_output/out',
                                                   expected_file.get_hash())
         sleep(5)
-        node_handler_process()
-        self.assertTrue(os.path.exists('/tmp/backup_output/out.SAME'))
+        result = node_handler_process()
+        self.assertEqual(result["status"], BackupStatus.SAME)
+
+    def test_backups_reuse_connection(self):
+        node_handler_process = NodeHandlerProcess('localhost', TestSidecar.PORT,
+                                                  '/tmp/example',
+                                                  '/tmp/backup_output/out',
+                                                  'dummy_checksum')
+        sleep(5)
+        result = node_handler_process()
+        self.assertEqual(result["status"], BackupStatus.SUCCESS)
+        sock = SIDECAR_CONNECTIONS[('localhost', TestSidecar.PORT)]
+        node_handler_process = NodeHandlerProcess('localhost', TestSidecar.PORT,
+                                                  '/tmp/example',
+                                                  '/tmp/backup_output/out3',
+                                                  result["checksum"])
+        result = node_handler_process()
+        self.assertEqual(result["status"], BackupStatus.SAME)
+        self.assertIs(SIDECAR_CONNECTIONS[('localhost', TestSidecar.PORT)], sock)
+
+    @unittest.skipUnless(hasattr(os, 'O_TMPFILE'), "requires O_TMPFILE")
+    def test_backup_fails_when_write_path_exists(self):
+        with open('/tmp/backup_output/out', 'w') as existing_file:
+            existing_file.write("existing")
+        node_handler_process = NodeHandlerProcess('localhost', TestSidecar.PORT,
+                                                  '/tmp/example',
+                                                  '/tmp/backup_output/out',
+                                                  'dummy_checksum')
+        sleep(5)
+        result = node_handler_process()
+        self.assertEqual(result["status"], BackupStatus.FAILED)
+        with open('/tmp/backup_output/out') as existing_file:
+            self.assertEqual(existing_file.read(), "existing")
 
     def test_node_handler_ends_when_unexistent_path(self):
         node_handler_process = NodeHandlerProcess('localhost', TestSidecar.PORT,
@@ -69,16 +104,16 @@ class TestSidecar(unittest.TestCase):
                                                   '/tmp/backup_output/out',
                                                   "dummy")
         sleep(5)
-        node_handler_process()
+        result = node_handler_process()
+        self.assertEqual(result["status"], BackupStatus.FAILED)
 
     def test_fail_to_receive_file(self):
         sleep(5)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect(('localhost', TestSidecar.PORT))
         socket_transferer = BlockingSocketTransferer(sock)
-        socket_transferer.send_plain_text(json.dumps({"checksum": "",
-                                                      "path": '/tmp/example'}))
-        _ = socket_transferer.receive_plain_text()
+        socket_transferer.send_backup_request("", '/tmp/example')
+        _ = socket_transferer.receive_backup_response()
         socket_transferer.close()
         sleep(5)
 